@@ -1 +1,2 @@
 from httptest.httptest import *
+from httptest.shared import ServerPool, SharedServer, SharedServerTimeout
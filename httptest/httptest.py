@@ -5,18 +5,29 @@ which is started and stopped using the httptest.Server() decorator.
 '''
 import os
 import io
+import re
+import ssl
 import json
+import time
+import random
+import struct
 import pickle
+import stat
 import socket
+import shutil
+import weakref
+import tempfile
+import subprocess
 import hashlib
 import inspect
 import platform
 import selectors
 import threading
+import http.client
 import http.server
 import urllib.request
 import multiprocessing
-from urllib.parse import urlparse, urljoin
+from urllib.parse import urlparse, urljoin, quote
 from contextlib import contextmanager
 
 if getattr(http.server, 'ThreadingHTTPServer', False):
@@ -45,11 +56,316 @@ class NotStarted(Exception):
     '''
     pass
 
+def self_signed_cert(cert_dir=None, hostname='localhost'):
+    '''
+    Returns the paths to a key and certificate for hostname (also valid for
+    127.0.0.1). They are generated with the openssl command line tool the
+    first time and reused from cert_dir afterwards, so only one test run ever
+    pays for key generation.
+    '''
+    if cert_dir is None:
+        cert_dir = os.path.join(os.path.expanduser('~'), '.cache', 'httptest',
+                                'tls')
+    pair_dir = os.path.join(cert_dir, hostname)
+    keyfile = os.path.join(pair_dir, 'key.pem')
+    certfile = os.path.join(pair_dir, 'cert.pem')
+    if os.path.isfile(keyfile) and os.path.isfile(certfile):
+        return keyfile, certfile
+    os.makedirs(cert_dir, exist_ok=True)
+    # Generate both files into a temporary directory and rename the directory
+    # into place in one step, so concurrent test processes never see a half
+    # written or mismatched key pair. If another process won the race its
+    # pair is used and ours is thrown away.
+    tempdir = tempfile.mkdtemp(dir=cert_dir)
+    try:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'ec',
+            '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+            '-days', '3650', '-subj', '/CN=' + hostname,
+            '-addext', 'subjectAltName=DNS:%s,IP:127.0.0.1' % (hostname,),
+            '-keyout', os.path.join(tempdir, 'key.pem'),
+            '-out', os.path.join(tempdir, 'cert.pem'),
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        os.rename(tempdir, pair_dir)
+    except OSError:
+        if not os.path.isdir(pair_dir):
+            raise
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+    return keyfile, certfile
+
+def server_ssl_context(keyfile, certfile):
+    '''
+    Create the SSLContext used for every connection to a Server. Session
+    tickets and the session cache stay enabled so clients which keep their
+    session around can resume instead of doing a full handshake.
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+    context.set_alpn_protocols(['http/1.1'])
+    context.options &= ~ssl.OP_NO_TICKET
+    return context
+
+_CLIENT_SSL_CONTEXT = None
+
+def client_ssl_context():
+    '''
+    Shared default SSLContext used to talk to upstream servers. Loading the
+    system CA store is expensive so it's only done once per process.
+    '''
+    global _CLIENT_SSL_CONTEXT
+    if _CLIENT_SSL_CONTEXT is None:
+        _CLIENT_SSL_CONTEXT = ssl.create_default_context()
+        _CLIENT_SSL_CONTEXT.set_alpn_protocols(['http/1.1'])
+    return _CLIENT_SSL_CONTEXT
+
+class ResumingHTTPSConnection(http.client.HTTPSConnection):
+    '''
+    HTTPSConnection which resumes the last TLS session it saw for the same
+    host and port, instead of doing a full handshake every time. Sessions are
+    remembered per SSLContext.
+
+    Example:
+        conn = httptest.ResumingHTTPSConnection(
+            'localhost', ts.server_port, context=ts.client_ssl_context())
+    '''
+
+    sessions = weakref.WeakKeyDictionary()
+
+    def __init__(self, *args, context=None, **kwargs):
+        if context is None:
+            context = client_ssl_context()
+        super().__init__(*args, context=context, **kwargs)
+        self.session_reused = False
+
+    def connect(self):
+        # Same as HTTPSConnection.connect() but passes the saved session
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host if self._tunnel_host \
+                          else self.host
+        session = self.sessions.get(self._context, {}).get(
+            (self.host, self.port))
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=server_hostname, session=session)
+        self.session_reused = self.sock.session_reused
+
+    def close(self):
+        # TLS 1.3 session tickets arrive after the handshake, so the session
+        # is saved once the response has been read
+        if isinstance(self.sock, ssl.SSLSocket) and \
+                self.sock.session is not None:
+            self.sessions.setdefault(self._context, {})[
+                (self.host, self.port)] = self.sock.session
+        super().close()
+
+class ResumingHTTPSHandler(urllib.request.HTTPSHandler):
+    '''
+    urllib handler making https requests with ResumingHTTPSConnection
+    '''
+
+    def __init__(self, context=None):
+        super().__init__(context=context)
+        self._resuming_context = context
+
+    def https_open(self, req):
+        return self.do_open(ResumingHTTPSConnection, req,
+                            context=self._resuming_context)
+
+def parse_range(value, size):
+    '''
+    Parse the value of a Range header for a body of size bytes. Returns a list
+    of inclusive (start, end) tuples, an empty list if none of the ranges can
+    be satisfied, or None if the header is malformed and should be ignored.
+    '''
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    ranges = []
+    for byte_range in spec.split(','):
+        start, sep, end = byte_range.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if not start:
+                # Suffix range, the last end bytes
+                length = int(end)
+                if length <= 0 or size == 0:
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else max(start, size - 1)
+        except ValueError:
+            return None
+        if end < start:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+    return ranges
+
+def sample_latency(latency):
+    '''
+    Seconds to delay for an injection profile's latency. latency is either a
+    number of seconds or a dict naming a distribution and its parameters.
+
+    Example:
+        0.1
+        {'distribution': 'uniform', 'min': 0.05, 'max': 0.2}
+        {'distribution': 'normal', 'mean': 0.1, 'stddev': 0.02}
+        {'distribution': 'lognormal', 'mu': -2.5, 'sigma': 0.8}
+        {'distribution': 'exponential', 'mean': 0.1}
+    '''
+    if not isinstance(latency, dict):
+        return float(latency)
+    distribution = latency.get('distribution', 'fixed')
+    if distribution == 'fixed':
+        delay = latency['value']
+    elif distribution == 'uniform':
+        delay = random.uniform(latency.get('min', 0), latency['max'])
+    elif distribution == 'normal':
+        delay = random.gauss(latency['mean'], latency['stddev'])
+    elif distribution == 'lognormal':
+        delay = random.lognormvariate(latency['mu'], latency['sigma'])
+    elif distribution == 'exponential':
+        delay = random.expovariate(1.0 / latency['mean'])
+    else:
+        raise ValueError('Unknown latency distribution %r' % (distribution,))
+    return max(delay, 0.0)
+
+class ThrottledWriter(io.BufferedIOBase):
+    '''
+    Wraps a Handler's wfile and paces writes to bandwidth bytes per second.
+    With slow_start the rate ramps up linearly from a trickle to bandwidth over
+    that many seconds. Pacing sleeps in the connection's own thread so other
+    connections are unaffected.
+    '''
+
+    def __init__(self, raw, bandwidth, slow_start=0):
+        super().__init__()
+        self.raw = raw
+        self.bandwidth = float(bandwidth)
+        self.slow_start = float(slow_start)
+        self.started = time.monotonic()
+        self.last = self.started
+
+    def rate(self, elapsed):
+        if self.slow_start <= 0 or elapsed >= self.slow_start:
+            return self.bandwidth
+        return self.bandwidth * max(elapsed / self.slow_start, 0.05)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        view = memoryview(data)
+        # Send roughly 50ms worth of data at a time
+        chunk_size = max(int(self.bandwidth / 20), 1)
+        for i in range(0, len(view), chunk_size):
+            chunk = view[i:i + chunk_size]
+            now = time.monotonic()
+            delay = len(chunk) / self.rate(now - self.started) \
+                    - (now - self.last)
+            if delay > 0:
+                time.sleep(delay)
+            self.raw.write(chunk)
+            self.last = time.monotonic()
+        return len(view)
+
+    def flush(self):
+        self.raw.flush()
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.raw.close()
+
+def synthetic_body(size, chunk_size=65536, seed=0):
+    '''
+    Generator of size bytes of pseudo random data, for serving arbitrarily
+    large bodies with Handler.stream(). A single chunk_size block is generated
+    and repeated, so memory use doesn't depend on size.
+    '''
+    generator = random.Random(seed)
+    block = memoryview(generator.getrandbits(chunk_size * 8).to_bytes(
+        chunk_size, 'little'))
+    while size > 0:
+        chunk = block[:min(size, chunk_size)]
+        size -= len(chunk)
+        yield chunk
+
 class Handler(http.server.SimpleHTTPRequestHandler):
     '''
     Handler to use with httptest.Server
+
+    Latency, bandwidth and faults can be injected by giving the Server a
+    config with an 'inject' list of profiles. The first profile whose 'path'
+    regex (and 'method', if given) matches the request is applied.
+
+    Example:
+        httptest.Server(TestHTTPServer, config={'inject': [
+            {
+                'path': '^/download/',
+                'latency': {'distribution': 'lognormal',
+                            'mu': -2.5, 'sigma': 0.8},
+                'bandwidth': 1024 * 1024,
+                'slow_start': 2,
+                'reset_rate': 0.01,
+                'error_rate': 0.05,
+                'error_status': [500, 502, 503],
+            },
+        ]})
     '''
 
+    def injection_profile(self):
+        '''
+        Returns the injection profile which applies to this request or None.
+        '''
+        config = getattr(self.server, 'config', None) or {}
+        for profile in config.get('inject', []):
+            if 'method' in profile and profile['method'] != self.command:
+                continue
+            if 'path' in profile and not re.search(profile['path'], self.path):
+                continue
+            return profile
+        return None
+
+    def inject(self, profile):
+        '''
+        Apply an injection profile to this request. Returns False if the
+        request was answered or dropped and should not be handled further.
+        '''
+        if random.random() < profile.get('reset_rate', 0):
+            # Abort the connection with a TCP RST
+            self.close_connection = True
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack('ii', 1, 0))
+            self.connection.close()
+            return False
+        if 'latency' in profile:
+            time.sleep(sample_latency(profile['latency']))
+        if random.random() < profile.get('error_rate', 0):
+            status = profile.get('error_status', 503)
+            if isinstance(status, (list, tuple)):
+                status = random.choice(status)
+            self.send_error(status)
+            return False
+        if profile.get('bandwidth'):
+            self.wfile = ThrottledWriter(self.wfile, profile['bandwidth'],
+                                         profile.get('slow_start', 0))
+        return True
+
+    def parse_request(self):
+        if isinstance(self.wfile, ThrottledWriter):
+            # Don't carry throttling over to the next request on the connection
+            self.wfile = self.wfile.raw
+        if not super().parse_request():
+            return False
+        profile = self.injection_profile()
+        if profile is None:
+            return True
+        return self.inject(profile)
+
     def json(self, data):
         '''
         Send a 200 with Content-type application/json using data as
@@ -60,6 +376,125 @@ class Handler(http.server.SimpleHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(json.dumps(data).encode('utf-8'))
 
+    def stream(self, body, status=200, content_type='application/octet-stream',
+               headers=None, length=None, buffer_size=65536):
+        '''
+        Send a response whose body is produced by iterating over body, which
+        yields bytes or str. Items are only pulled from body as fast as the
+        client reads them and at most buffer_size bytes are held at once.
+
+        With length the body is sent with a Content-Length, otherwise it uses
+        chunked transfer encoding if protocol_version is HTTP/1.1 and is
+        delimited by closing the connection for HTTP/1.0.
+        '''
+        chunked = length is None and self.protocol_version >= 'HTTP/1.1' \
+                  and self.request_version >= 'HTTP/1.1'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        for header, content in (headers or {}).items():
+            self.send_header(header, content)
+        if length is not None:
+            self.send_header('Content-Length', str(length))
+        elif chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+        self.end_headers()
+        write = self.write_chunk if chunked else self.wfile.write
+        buffered = bytearray()
+        try:
+            if self.command == 'HEAD':
+                return
+            for data in body:
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                if len(buffered) + len(data) < buffer_size:
+                    buffered += data
+                    continue
+                if buffered:
+                    write(buffered)
+                    buffered = bytearray()
+                if len(data) >= buffer_size:
+                    write(data)
+                else:
+                    buffered += data
+            if buffered:
+                write(buffered)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def write_chunk(self, data):
+        '''
+        Write data as one chunk of a chunked transfer encoded body
+        '''
+        if not data:
+            return
+        self.wfile.write(b'%X\r\n' % (len(data),))
+        self.wfile.write(data)
+        self.wfile.write(b'\r\n')
+
+    def ndjson(self, records, status=200, headers=None):
+        '''
+        Stream each item of records as a line of JSON.
+        '''
+        self.stream((json.dumps(record) + '\n' for record in records),
+                    status=status, content_type='application/x-ndjson',
+                    headers=headers)
+
+    def sse(self, events, headers=None):
+        '''
+        Stream server-sent events. Each event is either a str, sent as the
+        event's data, or a dict with data and optionally event, id and retry.
+        data which isn't a str is sent as JSON.
+        Events are sent to the client as soon as they are produced.
+        '''
+        def encode():
+            for event in events:
+                if not isinstance(event, dict):
+                    event = {'data': event}
+                message = ''
+                for field in ('event', 'id', 'retry'):
+                    if field in event:
+                        message += '%s: %s\n' % (field, event[field])
+                data = event.get('data', '')
+                if not isinstance(data, str):
+                    data = json.dumps(data)
+                for line in data.split('\n'):
+                    message += 'data: %s\n' % (line,)
+                yield message + '\n'
+        headers = dict(headers or {})
+        headers.setdefault('Cache-Control', 'no-cache')
+        # Don't hold events back to fill a buffer
+        self.stream(encode(), content_type='text/event-stream',
+                    headers=headers, buffer_size=1)
+
+    def sendfile(self, fd, offset=0, count=None):
+        '''
+        Send count bytes (or everything) of the file object fd starting at
+        offset straight from the file to the client socket, using sendfile()
+        where the platform supports it.
+        '''
+        if count == 0:
+            return
+        if isinstance(self.wfile, ThrottledWriter):
+            # Bandwidth is being limited, everything must go through wfile
+            fd.seek(offset)
+            while count is None or count > 0:
+                chunk = fd.read(65536 if count is None else min(count, 65536))
+                if not chunk:
+                    break
+                self.wfile.write(chunk)
+                if count is not None:
+                    count -= len(chunk)
+            return
+        self.wfile.flush()
+        self.connection.sendfile(fd, offset, count)
+
     #pylint: disable=arguments-differ
     def log_message(self, *args):
         '''
@@ -73,20 +508,30 @@ class CachingProxyHandler(Handler):
     server.
     '''
 
+    # Locks are striped by key so their number stays fixed however many
+    # objects a long running proxy sees
+    _cache_locks = [threading.Lock() for _ in range(64)]
+
     @classmethod
-    def to(cls, upstream, state_dir=None):
+    def to(cls, upstream, state_dir=None, ssl_context=None):
         '''
         Creates a CachingProxyHandler which will proxy requests to an upstream
-        server.
+        server. ssl_context is used for https upstreams, it defaults to a
+        context shared by all proxies which verifies against the system CAs.
         '''
         if state_dir is None:
             state_dir = os.path.join(os.getcwd(), '.cache', 'httptest')
+        if ssl_context is None:
+            ssl_context = client_ssl_context()
 
         upstream = urlparse(upstream)
+        opener = urllib.request.build_opener(
+            ResumingHTTPSHandler(context=ssl_context))
 
         class ConfiguredCachingProxyHandler(cls):
             UPSTREAM = upstream
             STATE_DIR = state_dir
+            OPENER = opener
         return ConfiguredCachingProxyHandler
 
     def proxied_url(self):
@@ -126,31 +571,57 @@ class CachingProxyHandler(Handler):
         return digest.hexdigest(), body
 
     @contextmanager
+    def cache_lock(self, key):
+        '''
+        Hold the lock guarding a cache key, shared by all requests handled by
+        this process. Unrelated keys may share a lock.
+        '''
+        locks = CachingProxyHandler._cache_locks
+        with locks[hash(self.cache_path(key)) % len(locks)]:
+            yield
+
+    @contextmanager
+    def cache_file(self, name, mode):
+        '''
+        Open a cache file for writing. It's written under a temporary name and
+        moved into place once complete, so readers never see partial files.
+        '''
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_path(),
+                                        prefix=name + '.', suffix='.tmp')
+        try:
+            with open(fd, mode) as fd:
+                yield fd
+            os.replace(tmp_path, self.cache_path(name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
     def save_cache(self, key, req, status, headers, body):
-        with open(self.cache_path(key + '.hits'), 'w') as fd:
-            fd.write(str(0))
-        with open(self.cache_path(key + '.request.pickle'), 'wb') as fd:
-            pickle.dump(req, fd, pickle.HIGHEST_PROTOCOL)
-        with open(self.cache_path(key + '.url'), 'w') as fd:
-            fd.write(req.get_full_url())
-        with open(self.cache_path(key + '.status'), 'w') as fd:
-            fd.write(str(status))
-        with open(self.cache_path(key + '.headers'), 'w') as fd:
-            json.dump(dict(headers._headers), fd)
-        with open(self.cache_path(key + '.body'), 'wb') as fd:
-            fd.write(body.read())
-        with open(self.cache_path(key + '.response.pickle'), 'wb') as fd:
-            pickle.dump(body, fd, pickle.HIGHEST_PROTOCOL)
-        with open(self.cache_path(key + '.body'), 'rb') as fd:
-            yield fd
+        # The body is moved into place last, once it exists the entry is
+        # complete as far as cached() is concerned
+        with self.cache_file(key + '.body', 'wb') as body_fd:
+            shutil.copyfileobj(body, body_fd)
+            with self.cache_file(key + '.hits', 'w') as fd:
+                fd.write(str(0))
+            with self.cache_file(key + '.request.pickle', 'wb') as fd:
+                pickle.dump(req, fd, pickle.HIGHEST_PROTOCOL)
+            with self.cache_file(key + '.url', 'w') as fd:
+                fd.write(req.get_full_url())
+            with self.cache_file(key + '.status', 'w') as fd:
+                fd.write(str(status))
+            with self.cache_file(key + '.headers', 'w') as fd:
+                json.dump(dict(headers._headers), fd)
+            with self.cache_file(key + '.response.pickle', 'wb') as fd:
+                pickle.dump(body, fd, pickle.HIGHEST_PROTOCOL)
 
     @contextmanager
-    def load_cache(self, key):
-        if os.path.exists(self.cache_path(key + '.hits')):
-            with open(self.cache_path(key + '.hits'), 'r') as fd:
-                hits = int(fd.read())
-            with open(self.cache_path(key + '.hits'), 'w') as fd:
-                fd.write(str(hits + 1))
+    def load_cache(self, key, hit=True):
+        if hit and os.path.exists(self.cache_path(key + '.hits')):
+            with self.cache_lock(key):
+                with open(self.cache_path(key + '.hits'), 'r') as fd:
+                    hits = int(fd.read())
+                with self.cache_file(key + '.hits', 'w') as fd:
+                    fd.write(str(hits + 1))
         with open(self.cache_path(key + '.status'), 'r') as fd:
             status = int(fd.read())
         with open(self.cache_path(key + '.headers'), 'r') as fd:
@@ -158,52 +629,143 @@ class CachingProxyHandler(Handler):
         with open(self.cache_path(key + '.body'), 'rb') as fd:
             yield status, headers, fd
 
+    def requested_ranges(self, headers, size):
+        '''
+        The byte ranges the client asked for, or None if the whole body should
+        be sent. An If-Range which doesn't match the cached ETag or
+        Last-Modified means the client's partial copy is stale. If-Range
+        requires a strong comparison, so weak ETags never match.
+        '''
+        if self.range is None:
+            return None
+        if self.if_range is not None:
+            if self.if_range.startswith('W/'):
+                return None
+            validators = [content for header, content in headers
+                          if header.lower() in ('etag', 'last-modified')]
+            if self.if_range not in validators:
+                return None
+        return parse_range(self.range, size)
+
+    def send_cached(self, status, headers, fd):
+        '''
+        Respond with a cached body. Range requests against a complete (200)
+        GET response are answered with 206 slices of the cached body, so only
+        one copy of each object is ever fetched and stored.
+        '''
+        headers = list(headers)
+        size = os.fstat(fd.fileno()).st_size
+        ranges = None
+        # Cached HEAD responses have no body to slice
+        if status == 200 and self.command == 'GET':
+            ranges = self.requested_ranges(headers, size)
+            if not any(header.lower() == 'accept-ranges'
+                       for header, _ in headers):
+                headers.append(('Accept-Ranges', 'bytes'))
+        if ranges is None:
+            self.send_response(status)
+            for header, content in headers:
+                self.send_header(header, content)
+            self.end_headers()
+            self.sendfile(fd)
+            return
+        # Strip the headers describing the full body
+        headers = [(header, content) for header, content in headers
+                   if header.lower() not in ('content-length',
+                                             'content-range',
+                                             'transfer-encoding')]
+        if not ranges:
+            self.send_response(416)
+            for header, content in headers:
+                if header.lower() != 'content-type':
+                    self.send_header(header, content)
+            self.send_header('Content-Range', 'bytes */%d' % (size,))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(206)
+        if len(ranges) == 1:
+            start, end = ranges[0]
+            for header, content in headers:
+                self.send_header(header, content)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            self.sendfile(fd, start, end - start + 1)
+            return
+        # Multiple ranges are sent as multipart/byteranges
+        content_type = 'application/octet-stream'
+        for header, content in headers:
+            if header.lower() == 'content-type':
+                content_type = content
+        boundary = hashlib.sha256(os.urandom(16)).hexdigest()[:32]
+        parts = []
+        for start, end in ranges:
+            parts.append((('--%s\r\nContent-Type: %s\r\n'
+                           'Content-Range: bytes %d-%d/%d\r\n\r\n') % (
+                               boundary, content_type, start, end, size,
+                           )).encode('latin-1'))
+        closing = ('--%s--\r\n' % (boundary,)).encode('latin-1')
+        length = len(closing) + sum(len(part) + (end - start + 1) + 2
+                                    for part, (start, end) in zip(parts, ranges))
+        for header, content in headers:
+            if header.lower() != 'content-type':
+                self.send_header(header, content)
+        self.send_header('Content-Type',
+                         'multipart/byteranges; boundary=' + boundary)
+        self.send_header('Content-Length', str(length))
+        self.end_headers()
+        for part, (start, end) in zip(parts, ranges):
+            self.wfile.write(part)
+            self.sendfile(fd, start, end - start + 1)
+            self.wfile.write(b'\r\n')
+        self.wfile.write(closing)
+
     def do_forward(self):
         '''
         Forward the request by making a similar request with urllib
         '''
         self.headers.replace_header('Host', self.UPSTREAM.netloc)
+        # Always fetch and cache the full object, slices are served from it
+        self.range = self.headers.get('Range')
+        self.if_range = self.headers.get('If-Range')
+        del self.headers['Range']
+        del self.headers['If-Range']
         key, data = self.cache_key()
-        if self.cached(key):
-            # Load from cache
-            if data is not None:
-                data.close()
-            with self.load_cache(key) as (status, headers, fd):
-                self.send_response(status)
-                for header, content in headers.items():
-                    self.send_header(header, content)
-                self.end_headers()
-                try:
-                    self.wfile.write(fd.read())
-                except BrokenPipeError:
-                    pass
-        else:
-            # Run request (not cached)
-            req = urllib.request.Request(self.proxied_url(),
-                                         headers=self.headers,
-                                         data=data,
-                                         method=self.command)
-            try:
-                with urllib.request.urlopen(req) as f:
-                    self.send_response(f.status)
-                    for header, content in f.headers.items():
-                        self.send_header(header, content)
-                    self.end_headers()
-                    with self.save_cache(key, req, f.status, f.headers, f) as c:
+        fetched = False
+        if not self.cached(key):
+            # Only one request per key goes upstream, concurrent requests for
+            # the same object wait for it and are served from the cache
+            with self.cache_lock(key):
+                if not self.cached(key):
+                    # Run request (not cached)
+                    req = urllib.request.Request(self.proxied_url(),
+                                                 headers=self.headers,
+                                                 data=data,
+                                                 method=self.command)
+                    try:
+                        with self.OPENER.open(req) as f:
+                            self.save_cache(key, req, f.status, f.headers, f)
+                        fetched = True
+                    except urllib.error.HTTPError as e:
+                        self.send_response(e.status, message=e.reason)
+                        for header, content in e.headers.items():
+                            self.send_header(header, content)
+                        self.end_headers()
                         try:
-                            self.wfile.write(c.read())
+                            self.wfile.write(e.read())
                         except BrokenPipeError:
                             pass
-            except urllib.error.HTTPError as e:
-                self.send_response(e.status, message=e.reason)
-                for header, content in e.headers.items():
-                    self.send_header(header, content)
-                self.end_headers()
-                try:
-                    self.wfile.write(e.read())
-                except BrokenPipeError:
-                    pass
-
+                        return
+        # Load from cache
+        if data is not None:
+            data.close()
+        with self.load_cache(key, hit=not fetched) as (status, headers, fd):
+            try:
+                self.send_cached(status, headers.items(), fd)
+            except BrokenPipeError:
+                pass
 
 # Make sure CachingProxyHandler responds to all HTTP methods
 for method in 'GET HEAD POST PUT DELETE CONNECT OPTIONS TRACE PATCH'.split():
@@ -216,11 +778,32 @@ class HTTPServer(ThreadingHTTPServer):
 
     allow_reuse_address = True
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, ssl_context=None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.ssl_context = ssl_context
         self.__server = False
         self.__control_send = False
 
+    def get_request(self):
+        '''
+        Accept a connection, wrapping it in TLS if we have an ssl_context. The
+        handshake is deferred to the request's thread so a slow client never
+        holds up the accept loop.
+        '''
+        request, client_address = super().get_request()
+        if self.ssl_context is not None:
+            request = self.ssl_context.wrap_socket(
+                request, server_side=True, do_handshake_on_connect=False)
+        return request, client_address
+
+    def finish_request(self, request, client_address):
+        if self.ssl_context is not None:
+            try:
+                request.do_handshake()
+            except (ssl.SSLError, OSError):
+                return
+        super().finish_request(request, client_address)
+
     #pylint: disable=arguments-differ
     def serve_forever(self, addr_queue, control_recv):
         '''
@@ -270,6 +853,70 @@ class HTTPServer(ThreadingHTTPServer):
         self.__server = False
         self.__control_send = False
 
+class UnixHTTPServer(HTTPServer):
+    '''
+    HTTPServer listening on a Unix domain socket, for local clients which
+    don't need to go through TCP. server_address is the socket's path.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        # NOTE Set here rather than on the class so that importing httptest
+        # works on platforms without AF_UNIX
+        self.address_family = socket.AF_UNIX
+        super().__init__(*args, **kwargs)
+
+    def stale_socket(self):
+        '''
+        True if server_address is a socket nothing is listening on anymore,
+        left behind by a previous run.
+        '''
+        try:
+            if not stat.S_ISSOCK(os.lstat(self.server_address).st_mode):
+                return False
+        except FileNotFoundError:
+            return False
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(self.server_address)
+            except ConnectionRefusedError:
+                return True
+        return False
+
+    def server_bind(self):
+        # Anything else at the path makes bind() fail with EADDRINUSE
+        if self.stale_socket():
+            os.unlink(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_address = self.socket.getsockname()
+        self.server_name = self.server_address
+        self.server_port = 0
+
+    def get_request(self):
+        request, _client_address = super().get_request()
+        # Unix sockets have no client address, BaseHTTPRequestHandler
+        # expects a (host, port) tuple
+        return request, ('localhost', 0)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    '''
+    http.client connection to a Server listening on a Unix domain socket.
+
+    Example:
+        with httptest.Server(TestHTTPServer, addr='/tmp/test.sock') as ts:
+            conn = httptest.UnixHTTPConnection(ts.unix_socket)
+            conn.request('GET', '/')
+    '''
+
+    def __init__(self, unix_socket, *args, **kwargs):
+        super().__init__('localhost', *args, **kwargs)
+        self.unix_socket = unix_socket
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_socket)
+
 class NoServer(object):
     '''
     Used for setting the test server (ts) to a default value for
@@ -301,15 +948,31 @@ class Server(object):
                     self.assertEqual(f.read().decode("utf-8"), "[2, 4]")
     '''
 
-    def __init__(self, testServerClass, addr=('127.0.0.1', 0), keyfile=None, certfile=None, config=None):
+    def __init__(self, testServerClass, addr=('127.0.0.1', 0), keyfile=None, certfile=None, config=None, ssl_context=None, self_signed=False):
         self.config = config if config is not None else {}
         self._class = testServerClass
         self._addr = addr
+        if self_signed and not (keyfile and certfile):
+            keyfile, certfile = self_signed_cert()
         self._keyfile = keyfile
         self._certfile = certfile
+        # NOTE Built once and reused every time the server is entered so that
+        # certificates are only parsed once and TLS sessions stay resumable.
+        self.ssl_context = ssl_context
+        if self.ssl_context is None and self._keyfile and self._certfile:
+            self.ssl_context = server_ssl_context(self._keyfile, self._certfile)
         self._protocol = "http"
-        if self._keyfile and self._certfile:
+        if self.ssl_context is not None:
             self._protocol = "https"
+        # A path as addr means listen on a Unix domain socket
+        self.unix_socket = None
+        if isinstance(addr, (str, os.PathLike)):
+            if not hasattr(socket, 'AF_UNIX'):
+                raise ValueError('Unix domain sockets are not supported on '
+                                 'this platform, cannot listen on %r'
+                                 % (addr,))
+            self.unix_socket = os.fspath(addr)
+            addr = (self.unix_socket, 0)
         self.server_name = "localhost"
         # NOTE This variable holds the reported server name after bind.
         # Python seems to be doing some kind of reverse lookup on the
@@ -335,24 +998,40 @@ class Server(object):
         return wrap
 
     def __enter__(self):
-        self.server = HTTPServer(self._addr, self._class)
+        if self.unix_socket is not None:
+            self.server = UnixHTTPServer(self.unix_socket, self._class,
+                                         ssl_context=self.ssl_context)
+        else:
+            self.server = HTTPServer(self._addr, self._class,
+                                     ssl_context=self.ssl_context)
         self.server.config = self.config
-        if self._keyfile and self._certfile:
-            self.server.socket = ssl.wrap_socket(
-                self.server.socket,
-                keyfile=self._keyfile,
-                certfile=self._certfile,
-                server_side=True,
-            )
         self._server_name, self.server_port = self.server.start_background()
         return self
 
     def __exit__(self, _exc_type, _exc_value, _traceback):
         self.server.stop_background()
         self.server = None
+        if self.unix_socket is not None and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
 
     def url(self):
         '''
-        Server URL formatted as http://server_name:server_port/
+        Server URL formatted as http://server_name:server_port/ or as
+        http+unix://quoted_socket_path/ when listening on a Unix socket.
         '''
+        if self.unix_socket is not None:
+            return '{0}+unix://{1}/'.format(
+                self._protocol, quote(self.unix_socket, safe=''))
         return '{0}://{1}:{2}/'.format(self._protocol, self.server_name, self.server_port)
+
+    def client_ssl_context(self):
+        '''
+        SSLContext for clients which trusts this server's certificate. Use it
+        with ResumingHTTPSConnection to resume TLS sessions.
+        '''
+        if self._certfile is None:
+            raise ValueError('Server certificate unknown, pass certfile')
+        if getattr(self, '_client_ssl_context', None) is None:
+            self._client_ssl_context = ssl.create_default_context(
+                cafile=self._certfile)
+        return self._client_ssl_context
@@ -0,0 +1,35 @@
+'''
+pytest plugin providing session scoped httptest servers. Registered through
+the pytest11 entry point, so installing httptest is enough to use it.
+
+Example conftest.py:
+    @pytest.fixture(scope="session")
+    def oidc_server(httptest_servers):
+        return httptest_servers.start(
+            "oidc",
+            lambda: httptest.Server(TestOIDCHTTPServer, config=config),
+            shared=True,
+        )
+
+With pytest-xdist, shared=True servers are started by the first worker to
+request them and used by all the others.
+'''
+import os
+
+import pytest
+
+from .shared import ServerPool
+
+
+@pytest.fixture(scope="session")
+def httptest_servers(tmp_path_factory):
+    '''
+    ServerPool whose servers run until the end of the test session. Under
+    pytest-xdist the pool's directory is shared by all workers.
+    '''
+    shared_dir = tmp_path_factory.getbasetemp()
+    if os.environ.get("PYTEST_XDIST_WORKER"):
+        # Workers each get their own basetemp inside a common one
+        shared_dir = shared_dir.parent
+    with ServerPool(str(shared_dir / "httptest")) as pool:
+        yield pool
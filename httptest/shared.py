@@ -0,0 +1,236 @@
+'''
+Share httptest servers between test processes, for example pytest-xdist
+workers, so expensive servers are only started once per test run.
+'''
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import contextlib
+
+from .httptest import Server
+
+
+class SharedServerTimeout(Exception):
+    '''
+    Timed out waiting for another process sharing a server
+    '''
+    pass
+
+
+@contextlib.contextmanager
+def file_lock(path, timeout=60):
+    '''
+    Hold an exclusive lock across processes by creating path, which must not
+    exist. Works on every platform without extra dependencies.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            if time.monotonic() > deadline:
+                raise SharedServerTimeout(path)
+            time.sleep(0.01)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        os.unlink(path)
+
+
+def pid_alive(pid):
+    '''
+    True if the process with the given pid is still running.
+    '''
+    if platform.system() == 'Windows':
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        # PROCESS_QUERY_LIMITED_INFORMATION
+        handle = kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        success = kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        # STILL_ACTIVE
+        return bool(success) and exit_code.value == 259
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedServer(object):
+    '''
+    A Server started by another process. Only its address is known.
+    '''
+
+    def __init__(self, info):
+        self._url = info['url']
+        self.server_name = info['server_name']
+        self.server_port = info['server_port']
+        self.unix_socket = info['unix_socket']
+        self._certfile = info['certfile']
+        self._client_ssl_context = None
+
+    def url(self):
+        '''
+        URL of the server as reported by the process which started it
+        '''
+        return self._url
+
+    client_ssl_context = Server.client_ssl_context
+
+
+class ServerPool(object):
+    '''
+    Starts servers by name and keeps them running until close() is called.
+    Servers started with shared=True are started by the first process to ask
+    for them, other processes using the same shared_dir get a SharedServer
+    pointing at it. The process which started a shared server keeps it running
+    until every other process using it has called close() or exited, or for
+    at most release_timeout seconds if given.
+
+    timeout limits how long to wait for the lock guarding a shared server's
+    address, which is only held briefly (and while the server is started).
+
+    Example:
+        with httptest.ServerPool('/tmp/httptest') as pool:
+            ts = pool.start('oidc', lambda: httptest.Server(
+                TestOIDCHTTPServer, config=config), shared=True)
+            urllib.request.urlopen(ts.url() + '.well-known/jwks')
+    '''
+
+    def __init__(self, shared_dir=None, timeout=60, release_timeout=None):
+        self.shared_dir = shared_dir
+        self.timeout = timeout
+        self.release_timeout = release_timeout
+        self._tempdir = None
+        self.servers = {}
+        self.owned = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, _exc_type, _exc_value, _traceback):
+        self.close()
+
+    def directory(self):
+        '''
+        Directory holding locks, shared server addresses and Unix sockets
+        '''
+        if self.shared_dir is None:
+            self._tempdir = tempfile.mkdtemp(prefix='httptest-')
+            self.shared_dir = self._tempdir
+        os.makedirs(self.shared_dir, exist_ok=True)
+        return self.shared_dir
+
+    def unix_socket_path(self, name):
+        '''
+        Path for a server to listen on as a Unix domain socket.
+
+        Example:
+            pool.start('proxy', lambda: httptest.Server(
+                handler, addr=pool.unix_socket_path('proxy')), shared=True)
+        '''
+        return os.path.join(self.directory(), name + '.sock')
+
+    def start(self, name, factory, shared=False):
+        '''
+        Return the running server called name, calling factory to create the
+        Server if it hasn't been started yet.
+        '''
+        if name in self.servers:
+            return self.servers[name]
+        if not shared:
+            self.servers[name] = factory().__enter__()
+            return self.servers[name]
+        info_path = os.path.join(self.directory(), name + '.json')
+        with file_lock(info_path + '.lock', timeout=self.timeout):
+            info = None
+            if os.path.isfile(info_path):
+                with open(info_path, 'r') as fd:
+                    info = json.load(fd)
+                # Left behind by a process which died without cleaning up
+                if not pid_alive(info['owner']):
+                    info = None
+            if info is not None:
+                server = SharedServer(info)
+            else:
+                server = factory().__enter__()
+                info = {
+                    'url': server.url(),
+                    'server_name': server.server_name,
+                    'server_port': server.server_port,
+                    'unix_socket': server.unix_socket,
+                    'certfile': server._certfile,
+                    'owner': os.getpid(),
+                    'users': [],
+                }
+                self.owned[name] = info_path
+            info['users'].append(os.getpid())
+            with open(info_path, 'w') as fd:
+                json.dump(info, fd)
+        self.servers[name] = server
+        return server
+
+    def users(self, info_path, release=False):
+        '''
+        Returns the number of processes using a shared server, after removing
+        this process if release is True. Processes which exited without
+        releasing the server, for example crashed test workers, don't count.
+        '''
+        with file_lock(info_path + '.lock', timeout=self.timeout):
+            # The process which started the server gave up waiting on us
+            if not os.path.isfile(info_path):
+                return 0
+            with open(info_path, 'r') as fd:
+                info = json.load(fd)
+            users = [pid for pid in info['users'] if pid_alive(pid)]
+            if release and os.getpid() in users:
+                users.remove(os.getpid())
+            if users != info['users']:
+                info['users'] = users
+                with open(info_path, 'w') as fd:
+                    json.dump(info, fd)
+        return len(users)
+
+    def close(self):
+        '''
+        Stop all servers started by this pool, waiting for other processes
+        to finish with shared servers first.
+        '''
+        for name, server in self.servers.items():
+            if isinstance(server, SharedServer):
+                self.users(os.path.join(self.shared_dir, name + '.json'),
+                           release=True)
+        for info_path in self.owned.values():
+            deadline = None
+            if self.release_timeout is not None:
+                deadline = time.monotonic() + self.release_timeout
+            users = self.users(info_path, release=True)
+            # Other processes may still be running tests against the server
+            while users > 0 and (deadline is None
+                                 or time.monotonic() < deadline):
+                time.sleep(0.1)
+                users = self.users(info_path)
+            # Stop handing out the address before the server goes away
+            with file_lock(info_path + '.lock', timeout=self.timeout):
+                if os.path.isfile(info_path):
+                    os.unlink(info_path)
+        for server in self.servers.values():
+            if not isinstance(server, SharedServer):
+                server.__exit__(None, None, None)
+        self.servers = {}
+        self.owned = {}
+        if self._tempdir is not None:
+            shutil.rmtree(self._tempdir, ignore_errors=True)
+            self._tempdir = None
+            self.shared_dir = None
@@ -3,10 +3,14 @@
 Unit tests for httptest
 '''
 import os
+import json
+import time
 import glob
+import socket
 import asyncio
 import tempfile
 import unittest
+import threading
 import urllib.error
 import urllib.request
 
@@ -45,6 +49,66 @@ class TestServerMethods(unittest.TestCase):
         with urllib.request.urlopen(ts.url()) as f:
             self.assertEqual(f.read().decode('utf-8'), "what up")
 
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'No Unix sockets')
+    def test_unix_socket(self):
+        '''
+        Make sure the server can listen on a Unix domain socket.
+        '''
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'test.sock')
+            with httptest.Server(TestHTTPServer, addr=path) as ts:
+                self.assertTrue(ts.url().startswith('http+unix://%2F'))
+                conn = httptest.UnixHTTPConnection(ts.unix_socket)
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().read(), b"what up")
+                conn.close()
+            self.assertFalse(os.path.exists(path))
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'No Unix sockets')
+    def test_unix_socket_in_use(self):
+        '''
+        Make sure only stale sockets are replaced, not files or the socket of
+        a running server.
+        '''
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'test.sock')
+            with open(path, 'w') as fd:
+                fd.write('not a socket')
+            with self.assertRaises(OSError):
+                httptest.Server(TestHTTPServer, addr=path).__enter__()
+            self.assertTrue(os.path.isfile(path))
+            os.unlink(path)
+            with httptest.Server(TestHTTPServer, addr=path) as ts:
+                with self.assertRaises(OSError):
+                    httptest.Server(TestHTTPServer, addr=path).__enter__()
+                conn = httptest.UnixHTTPConnection(ts.unix_socket)
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().read(), b"what up")
+                conn.close()
+            # Leave a socket nothing listens on behind
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            stale.bind(path)
+            stale.close()
+            with httptest.Server(TestHTTPServer, addr=path) as ts:
+                conn = httptest.UnixHTTPConnection(ts.unix_socket)
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().read(), b"what up")
+                conn.close()
+
+    def test_unix_socket_unsupported(self):
+        '''
+        Make sure a clear error is raised where Unix sockets don't exist.
+        '''
+        af_unix = getattr(socket, 'AF_UNIX', None)
+        if af_unix is not None:
+            del socket.AF_UNIX
+        try:
+            with self.assertRaisesRegex(ValueError, 'not supported'):
+                httptest.Server(TestHTTPServer, addr='test.sock')
+        finally:
+            if af_unix is not None:
+                socket.AF_UNIX = af_unix
+
     def test_async_call_response(self):
         '''
         Check that httptest.Server works for coroutine functions.
@@ -57,6 +121,39 @@ class TestServerMethods(unittest.TestCase):
         loop.run_until_complete(run_test())
         loop.close()
 
+class TestRangeHTTPServer(httptest.Handler):
+    '''
+    Handler for testing range requests against edge cases
+    '''
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "7")
+        self.end_headers()
+
+    def do_GET(self):
+        body = b"" if self.path == '/empty' else b"what up"
+        self.send_response(200)
+        self.send_header("ETag", 'W/"x"')
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class TestLargeHTTPServer(httptest.Handler):
+    '''
+    Handler serving a large body and counting requests
+    '''
+
+    SIZE = 4 * 1024 * 1024
+
+    def do_GET(self):
+        self.server.config['requests'] += 1
+        self.send_response(200)
+        self.send_header("Content-Length", str(self.SIZE))
+        self.end_headers()
+        for chunk in httptest.synthetic_body(self.SIZE):
+            self.wfile.write(chunk)
+
 class TestCachingMethods(unittest.TestCase):
     '''
     Test cases for httptest.CachingProxyHandler
@@ -83,6 +180,117 @@ class TestCachingMethods(unittest.TestCase):
 
             test_cached()
 
+    @httptest.Server(TestHTTPServer)
+    def test_forwards_range(self, ts=httptest.NoServer()):
+        '''
+        Make sure range requests are served from one cached copy.
+        '''
+        with tempfile.TemporaryDirectory() as tempdir:
+            @httptest.Server(httptest.CachingProxyHandler.to(ts.url(),
+                             state_dir=tempdir))
+            def test_cached(ts=httptest.NoServer()):
+                req = urllib.request.Request(ts.url() + 'get',
+                                             headers={'Range': 'bytes=0-3'})
+                with urllib.request.urlopen(req) as f:
+                    self.assertEqual(f.status, 206)
+                    self.assertEqual(f.headers['Content-Range'],
+                                     'bytes 0-3/7')
+                    self.assertEqual(f.read().decode('utf-8'), "what")
+                req = urllib.request.Request(ts.url() + 'get',
+                                             headers={'Range': 'bytes=-2'})
+                with urllib.request.urlopen(req) as f:
+                    self.assertEqual(f.read().decode('utf-8'), "up")
+                req = urllib.request.Request(ts.url() + 'get',
+                        headers={'Range': 'bytes=0-1,5-6'})
+                with urllib.request.urlopen(req) as f:
+                    self.assertTrue(f.headers['Content-Type'].startswith(
+                        'multipart/byteranges'))
+                    body = f.read().decode('utf-8')
+                    self.assertIn('Content-Range: bytes 0-1/7\r\n\r\nwh\r\n',
+                                  body)
+                    self.assertIn('Content-Range: bytes 5-6/7\r\n\r\nup\r\n',
+                                  body)
+                req = urllib.request.Request(ts.url() + 'get',
+                                             headers={'Range': 'bytes=100-'})
+                with self.assertRaises(urllib.error.HTTPError) as error:
+                    urllib.request.urlopen(req)
+                self.assertEqual(error.exception.status, 416)
+                error.exception.close()
+                with urllib.request.urlopen(ts.url() + 'get') as f:
+                    self.assertEqual(f.read().decode('utf-8'), "what up")
+                self.assertEqual(len(list(glob.glob(os.path.join(tempdir,
+                    '*.body')))), 1)
+
+            test_cached()
+
+    @httptest.Server(TestRangeHTTPServer)
+    def test_forwards_range_edge_cases(self, ts=httptest.NoServer()):
+        '''
+        Make sure empty bodies, HEAD requests and weak If-Range validators
+        aren't sliced.
+        '''
+        with tempfile.TemporaryDirectory() as tempdir:
+            @httptest.Server(httptest.CachingProxyHandler.to(ts.url(),
+                             state_dir=tempdir))
+            def test_cached(ts=httptest.NoServer()):
+                for _ in range(2):
+                    req = urllib.request.Request(ts.url() + 'empty',
+                                                 headers={'Range': 'bytes=-5'})
+                    with self.assertRaises(urllib.error.HTTPError) as error:
+                        urllib.request.urlopen(req)
+                    self.assertEqual(error.exception.status, 416)
+                    error.exception.close()
+                for _ in range(2):
+                    req = urllib.request.Request(ts.url() + 'get',
+                                                 headers={'Range': 'bytes=0-3'},
+                                                 method='HEAD')
+                    with urllib.request.urlopen(req) as f:
+                        self.assertEqual(f.status, 200)
+                        self.assertEqual(f.headers['Content-Length'], '7')
+                req = urllib.request.Request(ts.url() + 'get', headers={
+                    'Range': 'bytes=0-3', 'If-Range': 'W/"x"'})
+                with urllib.request.urlopen(req) as f:
+                    self.assertEqual(f.status, 200)
+                    self.assertEqual(f.read(), b"what up")
+
+            test_cached()
+
+    @httptest.Server(TestLargeHTTPServer, config={'requests': 0})
+    def test_forwards_parallel_ranges(self, ts=httptest.NoServer()):
+        '''
+        Make sure parallel range requests for an uncached object only fetch
+        it from upstream once and are all served from the cached copy.
+        '''
+        upstream = ts
+        size = TestLargeHTTPServer.SIZE
+        expected = b''.join(httptest.synthetic_body(size))
+        slices = 8
+        results = {}
+        with tempfile.TemporaryDirectory() as tempdir:
+            @httptest.Server(httptest.CachingProxyHandler.to(upstream.url(),
+                             state_dir=tempdir))
+            def test_cached(ts=httptest.NoServer()):
+                def download(i):
+                    start = i * size // slices
+                    end = (i + 1) * size // slices - 1
+                    req = urllib.request.Request(ts.url() + 'big',
+                        headers={'Range': 'bytes=%d-%d' % (start, end)})
+                    with urllib.request.urlopen(req) as f:
+                        results[i] = (f.status, f.read())
+                threads = [threading.Thread(target=download, args=(i,))
+                           for i in range(slices)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+
+            test_cached()
+        self.assertEqual(upstream.config['requests'], 1)
+        self.assertEqual([status for status, _ in results.values()],
+                         [206] * slices)
+        self.assertEqual(b''.join(results[i][1] for i in range(slices)),
+                         expected)
+
     @httptest.Server(TestHTTPServer)
     def test_forwards_error(self, ts=httptest.NoServer()):
         '''
@@ -99,6 +307,72 @@ class TestCachingMethods(unittest.TestCase):
 
             test_cached()
 
+class TestHTTPSMethods(unittest.TestCase):
+    '''
+    Test cases for serving and proxying over TLS
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.keyfile, self.certfile = httptest.self_signed_cert(
+            self.tempdir.name)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_self_signed_cert_cached(self):
+        '''
+        Make sure the generated key pair is reused.
+        '''
+        self.assertEqual(httptest.self_signed_cert(self.tempdir.name),
+                         (self.keyfile, self.certfile))
+
+    def test_call_response(self):
+        '''
+        Make sure we can read the server's response over https, and that the
+        SSLContext is reused when the server is started again.
+        '''
+        ts = httptest.Server(TestHTTPServer, keyfile=self.keyfile,
+                             certfile=self.certfile)
+        context = ts.ssl_context
+        for _ in range(2):
+            with ts:
+                self.assertTrue(ts.url().startswith('https://localhost:'))
+                with urllib.request.urlopen(ts.url(),
+                        context=ts.client_ssl_context()) as f:
+                    self.assertEqual(f.read().decode('utf-8'), "what up")
+            self.assertIs(ts.ssl_context, context)
+
+    def test_session_resumption(self):
+        '''
+        Make sure a second connection resumes the first one's TLS session.
+        '''
+        with httptest.Server(TestHTTPServer, keyfile=self.keyfile,
+                             certfile=self.certfile) as ts:
+            reused = []
+            for _ in range(2):
+                conn = httptest.ResumingHTTPSConnection(
+                    'localhost', ts.server_port,
+                    context=ts.client_ssl_context())
+                conn.request('GET', '/')
+                self.assertEqual(conn.getresponse().read(), b"what up")
+                reused.append(conn.session_reused)
+                conn.close()
+            self.assertEqual(reused, [False, True])
+
+    def test_forwards_get(self):
+        '''
+        Make sure the caching proxy can talk to an https upstream.
+        '''
+        upstream = httptest.Server(TestHTTPServer, keyfile=self.keyfile,
+                                   certfile=self.certfile)
+        with upstream, tempfile.TemporaryDirectory() as tempdir:
+            with httptest.Server(httptest.CachingProxyHandler.to(
+                    upstream.url(), state_dir=tempdir,
+                    ssl_context=upstream.client_ssl_context())) as ts:
+                with urllib.request.urlopen(ts.url() + 'get') as f:
+                    self.assertEqual(f.read().decode('utf-8'), "what up")
+
 class TestJSONServer(httptest.Handler):
     '''
     Handler for testing httptest.Handler
@@ -123,5 +397,165 @@ class TestHandlerMethods(unittest.TestCase):
         with urllib.request.urlopen(ts.url()) as f:
             self.assertEqual(f.read().decode('utf-8'), "[2, 4]")
 
+class ClosingBody(object):
+    '''
+    Streamed body recording whether it was closed
+    '''
+
+    def __init__(self, closed):
+        self.closed = closed
+
+    def __iter__(self):
+        yield b'what up'
+
+    def close(self):
+        self.closed.set()
+
+class TestStreamServer(httptest.Handler):
+    '''
+    Handler for testing streamed responses
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self.stream(ClosingBody(self.server.config['closed']))
+
+    def do_GET(self):
+        if self.path == '/ndjson':
+            self.ndjson({'i': i} for i in range(3))
+        elif self.path == '/sse':
+            self.sse(['hello', {'data': {'a': 1}},
+                      {'event': 'done', 'id': 1, 'data': 'a\nb'}])
+        elif self.path == '/synthetic':
+            size = 1024 * 1024 + 1
+            self.stream(httptest.synthetic_body(size), length=size)
+        else:
+            self.stream(iter(['what', b' ', 'up']))
+
+class TestStreamMethods(unittest.TestCase):
+    '''
+    Test cases for httptest.Handler streaming helpers
+    '''
+
+    @httptest.Server(TestStreamServer)
+    def test_chunked(self, ts=httptest.NoServer()):
+        '''
+        Make sure bodies without a length use chunked transfer encoding.
+        '''
+        with urllib.request.urlopen(ts.url()) as f:
+            self.assertEqual(f.headers['Transfer-Encoding'], 'chunked')
+            self.assertEqual(f.read().decode('utf-8'), "what up")
+
+    @httptest.Server(type('TestStreamServer10', (TestStreamServer,),
+                          {'protocol_version': 'HTTP/1.0'}))
+    def test_close_delimited(self, ts=httptest.NoServer()):
+        '''
+        Make sure HTTP/1.0 responses are delimited by closing the connection.
+        '''
+        with urllib.request.urlopen(ts.url()) as f:
+            self.assertIsNone(f.headers['Transfer-Encoding'])
+            self.assertEqual(f.read().decode('utf-8'), "what up")
+
+    @httptest.Server(TestStreamServer, config={'closed': threading.Event()})
+    def test_head_closes_body(self, ts=httptest.NoServer()):
+        '''
+        Make sure HEAD requests send no body but still close it.
+        '''
+        req = urllib.request.Request(ts.url(), method='HEAD')
+        with urllib.request.urlopen(req) as f:
+            self.assertEqual(f.read(), b'')
+        self.assertTrue(ts.config['closed'].wait(5))
+
+    @httptest.Server(TestStreamServer)
+    def test_ndjson(self, ts=httptest.NoServer()):
+        '''
+        Make sure each record is sent as a line of JSON.
+        '''
+        with urllib.request.urlopen(ts.url() + 'ndjson') as f:
+            self.assertEqual(f.headers['Content-Type'], 'application/x-ndjson')
+            self.assertEqual([json.loads(line) for line in f],
+                             [{'i': 0}, {'i': 1}, {'i': 2}])
+
+    @httptest.Server(TestStreamServer)
+    def test_sse(self, ts=httptest.NoServer()):
+        '''
+        Make sure events are encoded as server-sent events.
+        '''
+        with urllib.request.urlopen(ts.url() + 'sse') as f:
+            self.assertEqual(f.headers['Content-Type'], 'text/event-stream')
+            self.assertEqual(f.read().decode('utf-8'),
+                             'data: hello\n\n'
+                             'data: {"a": 1}\n\n'
+                             'event: done\nid: 1\ndata: a\ndata: b\n\n')
+
+    @httptest.Server(TestStreamServer)
+    def test_synthetic_body(self, ts=httptest.NoServer()):
+        '''
+        Make sure synthetic bodies are the requested size and deterministic.
+        '''
+        with urllib.request.urlopen(ts.url() + 'synthetic') as f:
+            body = f.read()
+        self.assertEqual(len(body), 1024 * 1024 + 1)
+        self.assertEqual(body,
+                         b''.join(httptest.synthetic_body(1024 * 1024 + 1)))
+
+class TestInjectionServer(httptest.Handler):
+    '''
+    Handler for testing latency, bandwidth and fault injection
+    '''
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain")
+        self.end_headers()
+        self.wfile.write(b"a" * 2000)
+
+class TestInjectionMethods(unittest.TestCase):
+    '''
+    Test cases for injection profiles given via Server config
+    '''
+
+    @httptest.Server(TestInjectionServer, config={'inject': [
+        {'path': '^/slow', 'latency': 0.2},
+        {'path': '^/throttled', 'bandwidth': 10000},
+        {'path': '^/error', 'error_rate': 1, 'error_status': [502]},
+        {'path': '^/reset', 'reset_rate': 1},
+    ]})
+    def test_inject(self, ts=httptest.NoServer()):
+        '''
+        Make sure each kind of injection applies to its route only.
+        '''
+        elapsed = {}
+        for path in ('fast', 'slow', 'throttled'):
+            start = time.monotonic()
+            with urllib.request.urlopen(ts.url() + path) as f:
+                self.assertEqual(len(f.read()), 2000)
+            elapsed[path] = time.monotonic() - start
+        self.assertGreaterEqual(elapsed['slow'], 0.2)
+        self.assertGreaterEqual(elapsed['throttled'], 0.15)
+        self.assertLess(elapsed['fast'], elapsed['slow'])
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(ts.url() + 'error')
+        self.assertEqual(error.exception.status, 502)
+        error.exception.close()
+        with self.assertRaises(OSError):
+            urllib.request.urlopen(ts.url() + 'reset')
+
+    def test_sample_latency(self):
+        '''
+        Make sure latency distributions produce non-negative delays.
+        '''
+        self.assertEqual(httptest.sample_latency(0.5), 0.5)
+        for latency in [
+            {'distribution': 'uniform', 'min': 0.1, 'max': 0.2},
+            {'distribution': 'normal', 'mean': 0.0, 'stddev': 1.0},
+            {'distribution': 'lognormal', 'mu': -2.5, 'sigma': 0.8},
+            {'distribution': 'exponential', 'mean': 0.1},
+        ]:
+            self.assertGreaterEqual(httptest.sample_latency(latency), 0)
+        with self.assertRaises(ValueError):
+            httptest.sample_latency({'distribution': 'pareto'})
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+'''
+Tests for the httptest pytest plugin, run with pytest rather than unittest
+'''
+import importlib.metadata
+
+import pytest
+
+pytest_plugins = ["pytester"]
+
+def test_entry_point():
+    '''
+    Make sure installing httptest registers the plugin with pytest.
+    '''
+    try:
+        importlib.metadata.distribution("httptest")
+    except importlib.metadata.PackageNotFoundError:
+        pytest.skip("httptest is not installed")
+    entry_points = importlib.metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        pytest11 = entry_points.select(group="pytest11")
+    else:
+        pytest11 = entry_points.get("pytest11", [])
+    assert "httptest.pytest_plugin" in [
+        entry_point.value for entry_point in pytest11
+        if entry_point.name == "httptest"
+    ]
+
+def test_httptest_servers(pytester, request):
+    '''
+    Make sure the httptest_servers fixture starts a shared server once per
+    session and keeps it running between tests.
+    '''
+    pytester.makepyfile(
+        '''
+        import urllib.request
+
+        import pytest
+        import httptest
+
+        STARTED = []
+
+        class TestHTTPServer(httptest.Handler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(b"what up")
+
+        def factory():
+            STARTED.append(True)
+            return httptest.Server(TestHTTPServer)
+
+        @pytest.fixture(scope="session")
+        def server(httptest_servers):
+            return httptest_servers.start("test", factory, shared=True)
+
+        def test_one(server):
+            with urllib.request.urlopen(server.url()) as f:
+                assert f.read() == b"what up"
+
+        def test_two(server):
+            with urllib.request.urlopen(server.url()) as f:
+                assert f.read() == b"what up"
+            assert len(STARTED) == 1
+        '''
+    )
+    args = []
+    # Loaded through the pytest11 entry point when httptest is installed
+    if not request.config.pluginmanager.has_plugin("httptest"):
+        args = ["-p", "httptest.pytest_plugin"]
+    result = pytester.runpytest(*args)
+    result.assert_outcomes(passed=2)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+Unit tests for httptest.ServerPool
+'''
+import os
+import sys
+import json
+import time
+import socket
+import tempfile
+import subprocess
+import unittest
+import threading
+import urllib.request
+
+import httptest
+
+from .test_httptest import TestHTTPServer
+
+class TestServerPoolMethods(unittest.TestCase):
+    '''
+    Test cases for httptest.ServerPool
+    '''
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.started = 0
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def factory(self, **kwargs):
+        self.started += 1
+        return httptest.Server(TestHTTPServer, **kwargs)
+
+    def test_start(self):
+        '''
+        Make sure servers are started once per name and stopped on close.
+        '''
+        with httptest.ServerPool() as pool:
+            ts = pool.start('test', self.factory)
+            self.assertIs(pool.start('test', self.factory), ts)
+            self.assertEqual(self.started, 1)
+            with urllib.request.urlopen(ts.url()) as f:
+                self.assertEqual(f.read().decode('utf-8'), "what up")
+        self.assertIsNone(ts.server)
+
+    def test_shared(self):
+        '''
+        Make sure a second pool using the same directory reuses the server
+        started by the first instead of starting its own.
+        '''
+        owner = httptest.ServerPool(self.tempdir.name, timeout=5)
+        user = httptest.ServerPool(self.tempdir.name, timeout=5)
+        ts = owner.start('test', self.factory, shared=True)
+        shared = user.start('test', self.factory, shared=True)
+        self.assertEqual(self.started, 1)
+        self.assertIsInstance(shared, httptest.SharedServer)
+        self.assertEqual(shared.url(), ts.url())
+        with urllib.request.urlopen(shared.url()) as f:
+            self.assertEqual(f.read().decode('utf-8'), "what up")
+        user.close()
+        owner.close()
+        self.assertIsNone(ts.server)
+        self.assertEqual(os.listdir(self.tempdir.name), [])
+
+    def test_shared_outlives_lock_timeout(self):
+        '''
+        Make sure the process which started a shared server keeps it running
+        until others are done with it, even past the lock timeout.
+        '''
+        owner = httptest.ServerPool(self.tempdir.name, timeout=0.1)
+        user = httptest.ServerPool(self.tempdir.name, timeout=0.1)
+        ts = owner.start('test', self.factory, shared=True)
+        shared = user.start('test', self.factory, shared=True)
+        closing = threading.Thread(target=owner.close)
+        closing.start()
+        time.sleep(0.5)
+        self.assertTrue(closing.is_alive())
+        with urllib.request.urlopen(shared.url()) as f:
+            self.assertEqual(f.read().decode('utf-8'), "what up")
+        user.close()
+        closing.join()
+        self.assertIsNone(ts.server)
+
+    def exited_pid(self):
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        return process.pid
+
+    def test_shared_user_exited(self):
+        '''
+        Make sure a process which exited without releasing a shared server
+        doesn't keep the process which started it waiting.
+        '''
+        info_path = os.path.join(self.tempdir.name, 'test.json')
+        owner = httptest.ServerPool(self.tempdir.name, timeout=5)
+        ts = owner.start('test', self.factory, shared=True)
+        with open(info_path, 'r') as fd:
+            info = json.load(fd)
+        info['users'].append(self.exited_pid())
+        with open(info_path, 'w') as fd:
+            json.dump(info, fd)
+        closing = threading.Thread(target=owner.close)
+        closing.start()
+        closing.join(5)
+        self.assertFalse(closing.is_alive())
+        self.assertIsNone(ts.server)
+
+    def test_shared_owner_exited(self):
+        '''
+        Make sure a server left behind by a process which exited is started
+        again instead of being used.
+        '''
+        info_path = os.path.join(self.tempdir.name, 'test.json')
+        with open(info_path, 'w') as fd:
+            json.dump({'owner': self.exited_pid(), 'users': []}, fd)
+        with httptest.ServerPool(self.tempdir.name) as pool:
+            ts = pool.start('test', self.factory, shared=True)
+            self.assertIsInstance(ts, httptest.Server)
+            with urllib.request.urlopen(ts.url()) as f:
+                self.assertEqual(f.read().decode('utf-8'), "what up")
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'No Unix sockets')
+    def test_shared_unix_socket(self):
+        '''
+        Make sure shared servers can listen on a Unix socket.
+        '''
+        with httptest.ServerPool(self.tempdir.name) as pool:
+            ts = pool.start('test', lambda: self.factory(
+                addr=pool.unix_socket_path('test')), shared=True)
+            conn = httptest.UnixHTTPConnection(ts.unix_socket)
+            conn.request('GET', '/')
+            self.assertEqual(conn.getresponse().read(), b"what up")
+            conn.close()
+
+if __name__ == '__main__':
+    unittest.main()